@@ -2,15 +2,45 @@
 # MS5803_I2C
 # Library for MS5803 pressure sensor.
 ##
+import micropython
 from utime import sleep_ms
-from ucollections import namedtuple
+from ustruct import unpack
 
-OSR = namedtuple('OSR', ('address', 'sampling_time'))
+# Address modifier and conversion time (ms) for each OSR, indexed by MS5803.OSRs
+OSR_ADDR = (0x00, 0x02, 0x04, 0x06, 0x08)
+OSR_MS = (1, 2, 3, 5, 10)
 
 TEMP_UNITS = ['fahrenheit', 'celcius']
 PRESSURE_UNITS = ['pascals', 'bar']
 
-def convert_temperature(temp, units='celcius'):
+# Unit flags, each one is the index of its name in TEMP_UNITS/PRESSURE_UNITS
+UNIT_F = const(0)
+UNIT_C = const(1)
+UNIT_PA = const(0)
+UNIT_BAR = const(1)
+
+
+def _temp_unit_flag(units):
+    ''' Translate a temperature unit name or flag into its flag '''
+    if units == UNIT_F or units == UNIT_C:
+        return units
+    try:
+        return TEMP_UNITS.index(units)
+    except ValueError:
+        raise ValueError('The temperature unit must be one of {}'.format(TEMP_UNITS))
+
+
+def _pressure_unit_flag(units):
+    ''' Translate a pressure unit name or flag into its flag '''
+    if units == UNIT_PA or units == UNIT_BAR:
+        return units
+    try:
+        return PRESSURE_UNITS.index(units)
+    except ValueError:
+        raise ValueError('The pressure unit must be one of {}'.format(PRESSURE_UNITS))
+
+
+def convert_temperature(temp, units=UNIT_C):
     '''
     Convert a raw temperature to a chosen unit
     
@@ -18,24 +48,28 @@ def convert_temperature(temp, units='celcius'):
     ----------
     temp : int
         The raw temperature output from an MS5803 sensor
-    units : {default: 'celcius', 'fahrenheit'}
-        A string identifying the unit to convert to
+    units : {default: UNIT_C / 'celcius', UNIT_F / 'fahrenheit'}
+        A flag or name identifying the unit to convert to
 
     Returns
     ----------
     float
         The converted temperature
     '''
-    if units == 'fahrenheit':
-        converted_temp = temp / 100
+    return _convert_temperature(temp, _temp_unit_flag(units))
+
+
+@micropython.native
+def _convert_temperature(temp, units):
+    ''' convert_temperature() for a unit flag that is already known to be valid '''
+    converted_temp = temp / 100
+    if units == UNIT_F:
         converted_temp = (((converted_temp) * 9) / 5) + 32
-    elif units == 'celcius':
-        converted_temp = temp / 100
 
     return converted_temp
 
 
-def convert_pressure(pressure, units='pascals'):
+def convert_pressure(pressure, units=UNIT_PA):
     '''
     Convert a raw pressure to a chosen unit
     
@@ -43,21 +77,116 @@ def convert_pressure(pressure, units='pascals'):
     ----------
     pressure : int
         The raw pressure output from an MS5803 sensor
-    units : {default: 'pascals', 'bar'}
-        A string identifying the unit to convert to
+    units : {default: UNIT_PA / 'pascals', UNIT_BAR / 'bar'}
+        A flag or name identifying the unit to convert to
 
     Returns
     ----------
     float
         The converted pressure
     '''
-    if units == 'pascals':
-        converted_pressure = pressure / 10
-    elif units == 'bar':
+    return _convert_pressure(pressure, _pressure_unit_flag(units))
+
+
+@micropython.native
+def _convert_pressure(pressure, units):
+    ''' convert_pressure() for a unit flag that is already known to be valid '''
+    if units == UNIT_BAR:
         converted_pressure = pressure / 10000
+    else:
+        converted_pressure = pressure / 10
     return converted_pressure
 
 
+def _crc4(prom):
+    '''
+    Calculate the 4 bit CRC of the calibration PROM (see TE AN520)
+
+    Parameters
+    ----------
+    prom : list of int
+        The 8 words read from the PROM
+
+    Returns
+    ----------
+    int
+        The CRC, to be compared against the low nibble of prom[7]
+    '''
+    n_rem = 0
+    for cnt in range(16):
+        word = prom[cnt >> 1]
+        if cnt == 15:
+            word &= 0xFF00
+        if cnt & 1:
+            n_rem ^= word & 0xFF
+        else:
+            n_rem ^= word >> 8
+        for _ in range(8):
+            if n_rem & 0x8000:
+                n_rem = ((n_rem << 1) ^ 0x3000) & 0xFFFF
+            else:
+                n_rem = (n_rem << 1) & 0xFFFF
+    return (n_rem >> 12) & 0xF
+
+
+# The compensation needs intermediates wider than 32 bits (dT * dT, SENS * D1,
+# C2 << 16), so it uses the native emitter, which keeps arbitrary precision
+# ints, rather than viper or the inline assembler which work on 32 bit words.
+@micropython.native
+def _compensate(temp_raw, pressure_raw, c1_shifted, c2_shifted, c3, c4, c5_shifted, c6):
+    '''
+    Apply the first and second order compensation to the raw ADC readings
+
+    Parameters
+    ----------
+    temp_raw, pressure_raw : int
+        The raw temperature (D2) and pressure (D1) readings from the ADC
+    c1_shifted, c2_shifted, c5_shifted : int
+        The calibration coefficients C1 << 15, C2 << 16 and C5 << 8
+    c3, c4, c6 : int
+        The calibration coefficients C3, C4 and C6
+
+    Returns
+    ----------
+    tuple of ints
+        The compensated temperature (0.01 C) and pressure (0.1 mbar)
+    '''
+    # Convert raw temp to actual
+    dT = temp_raw - c5_shifted
+    temp = ((dT * c6) >> 23) + 2000
+
+    # Calculate the second order temp. This is left branched: with arbitrary
+    # precision ints under the native emitter a branchless, masked form would
+    # compute the terms for both temperature ranges on every sample
+    tm = temp - 2000
+    tm2 = tm * tm
+    if temp < 2000:
+        T2 = 3 * ((dT * dT) >> 33)
+        OFF2 = 3 * tm2 >> 1
+        SENS2 = 5 * tm2 >> 3
+
+        if temp < -1500:
+            tp = temp + 1500
+            tp2 = tp * tp
+            OFF2 = OFF2 + 7 * tp2
+            SENS2 = SENS2 + (tp2 << 2)
+    else:
+        T2 = 7 * (dT * dT) >> 37
+        OFF2 = tm2 >> 4
+        SENS2 = 0
+
+    # Bring it all together to apply offsets
+    OFF = c2_shifted + ((c4 * dT) >> 7) - OFF2
+    SENS = c1_shifted + ((c3 * dT) >> 8) - SENS2
+
+    temp = temp - T2
+
+    # Calculate the pressure
+    pressure = (((SENS * pressure_raw) >> 21) - OFF) >> 15
+
+    return (temp, pressure)
+
+
 class MS5803():
     '''MS5803-14BA temperature and pressure over i2c.
 
@@ -87,11 +216,11 @@ class MS5803():
 
     # Precision
     OSRs = {
-        256: OSR(0x00, 1),
-        512: OSR(0x02, 2),
-        1024: OSR(0x04, 3),
-        2048: OSR(0x06, 5),
-        4096: OSR(0x08, 10)
+        256: 0,
+        512: 1,
+        1024: 2,
+        2048: 3,
+        4096: 4
         }
 
     def __init__(self, i2c, address=0x76, temp_osr=256, pressure_osr=256, temp_units=None, pressure_units=None):
@@ -107,16 +236,18 @@ class MS5803():
         temp_osr, pressure_osr : {default: 256, 512, 1024, 2048, 4096} *optional
             The oversampling rate (OSR) for the temperature and pressure reading
             If not set the stored OSRs will be used
-        temp_units : {default: 'celcius', 'fahrenheit'} *optional
-            A string identifying the unit to convert the temperature to
+        temp_units : {'celcius' / UNIT_C, 'fahrenheit' / UNIT_F} *optional
+            A name or flag identifying the unit to convert the temperature to
             If not set the stored units will be used
-        pressure_units : {default: 'pascals', 'bar'} *optional
-            A string identifying the unit to convert the pressure to
+        pressure_units : {'pascals' / UNIT_PA, 'bar' / UNIT_BAR} *optional
+            A name or flag identifying the unit to convert the pressure to
             If not set the stored units will be used
 
         '''
         self.i2c = i2c
         self.address = address
+        self._adc_buf = bytearray(3)
+        self._lock = None
         self._begin()
         self.temp_osr = temp_osr
         self.pressure_osr = pressure_osr
@@ -144,35 +275,64 @@ class MS5803():
             C5 | Reference temperature | T_REF
             C6 | Temperature coefficient of the temperature | TEMPSENS
         '''
-        self.C = []
-        for i in range(8):
-            buf = self.i2c.readfrom_mem(self.address, self.CMD_PROM + (i * 2), 2)
-            self.C.append((buf[0] << 8)|buf[1])
+        # Read the whole PROM in a single transaction
+        buf = bytearray(16)
+        self.i2c.readfrom_mem_into(self.address, self.CMD_PROM, buf)
+        self.C = list(unpack('>8H', buf))
+
+        # Check C1 against a single word read, as the CRC alone cannot catch
+        # a burst that repeated one word instead of auto-incrementing
+        mv = memoryview(buf)
+        self.i2c.readfrom_mem_into(self.address, self.CMD_PROM + 2, mv[:2])
+        burst_ok = (self.C[1] == (buf[0] << 8) | buf[1]
+                    and self.C.count(self.C[0]) != 8
+                    and _crc4(self.C) == self.C[7] & 0xF)
+
+        # Otherwise fall back to reading word by word
+        if not burst_ok:
+            for i in range(8):
+                self.i2c.readfrom_mem_into(self.address, self.CMD_PROM + (i * 2), mv[i * 2:i * 2 + 2])
+            self.C = list(unpack('>8H', buf))
+
+            # A blank bus (all 0x00 or 0xFF) or corrupt PROM would otherwise
+            # silently skew every reading
+            if self.C.count(self.C[0]) == 8 or _crc4(self.C) != self.C[7] & 0xF:
+                raise OSError('The calibration PROM failed its CRC check')
+
+        # Cache the coefficients in the form used by the compensation
+        self._C1_shifted = self.C[1] << 15
+        self._C2_shifted = self.C[2] << 16
+        self._C3 = self.C[3]
+        self._C4 = self.C[4]
+        self._C5_shifted = self.C[5] << 8
+        self._C6 = self.C[6]
 
 
     @property
     def temp_units(self):
-        return self._temp_units
+        if self._temp_units is None:
+            return None
+        return TEMP_UNITS[self._temp_units]
 
     @temp_units.setter
     def temp_units(self, value):
-        if value:
-            assert value in TEMP_UNITS, 'The temperature unit must be one of {}'.format(TEMP_UNITS)
-            self._temp_units = value
-        else:
+        if value is None:
             self._temp_units = None
+        else:
+            self._temp_units = _temp_unit_flag(value)
 
     @property
     def pressure_units(self):
-        return self._temp_units
+        if self._pressure_units is None:
+            return None
+        return PRESSURE_UNITS[self._pressure_units]
 
     @pressure_units.setter
     def pressure_units(self, value):
-        if value:
-            assert value in PRESSURE_UNITS, 'The pressure unit must be one of {}'.format(PRESSURE_UNITS)
-            self._pressure_units = value
-        else:
+        if value is None:
             self._pressure_units = None
+        else:
+            self._pressure_units = _pressure_unit_flag(value)
 
     @property
     def temp_osr(self):
@@ -180,8 +340,10 @@ class MS5803():
 
     @temp_osr.setter
     def temp_osr(self, value):
-        assert value in self.OSRs.keys(), 'The sampling rate must be in the set {}'.format(self.OSRs.keys())
-        self._temp_osr = self.OSRs[value]
+        if value not in self.OSRs:
+            raise ValueError('The sampling rate must be in the set {}'.format(sorted(self.OSRs)))
+        self._temp_osr = value
+        self._temp_osr_idx = self.OSRs[value]
 
     @property
     def pressure_osr(self):
@@ -189,8 +351,39 @@ class MS5803():
 
     @pressure_osr.setter
     def pressure_osr(self, value):
-        assert value in self.OSRs.keys(), 'The sampling rate must be in the set {}'.format(self.OSRs.keys())
-        self._pressure_osr = self.OSRs[value]
+        if value not in self.OSRs:
+            raise ValueError('The sampling rate must be in the set {}'.format(sorted(self.OSRs)))
+        self._pressure_osr = value
+        self._pressure_osr_idx = self.OSRs[value]
+
+    def _configure(self, temp_osr, pressure_osr, temp_units, pressure_units):
+        ''' Store any settings passed to a measurement call, skipping unchanged OSRs '''
+        if temp_osr and temp_osr != self._temp_osr:
+            self.temp_osr = temp_osr
+
+        if pressure_osr and pressure_osr != self._pressure_osr:
+            self.pressure_osr = pressure_osr
+
+        if temp_units is not None:
+            self._temp_units = _temp_unit_flag(temp_units)
+
+        if pressure_units is not None:
+            self._pressure_units = _pressure_unit_flag(pressure_units)
+
+    def _calculate(self, temp_raw, pressure_raw):
+        ''' Compensate the raw ADC readings and convert them to the stored units '''
+        temp, pressure = _compensate(temp_raw, pressure_raw,
+            self._C1_shifted, self._C2_shifted, self._C3, self._C4,
+            self._C5_shifted, self._C6)
+
+        temp_units = self._temp_units
+        pressure_units = self._pressure_units
+        if temp_units is not None:
+            temp = _convert_temperature(temp, temp_units)
+        if pressure_units is not None:
+            pressure = _convert_pressure(pressure, pressure_units)
+
+        return (temp, pressure)
 
     def get_measurements(self, temp_osr=None, pressure_osr=None, temp_units=None, pressure_units=None):
         '''
@@ -201,11 +394,11 @@ class MS5803():
         temp_osr, pressure_osr : {256, 512, 1024, 2048, 4096} *optional
             The oversampling rate (OSR) for the temperature and pressure reading
             If not set the stored OSRs will be used
-        temp_units : {default: 'celcius', 'fahrenheit'} *optional
-            A string identifying the unit to convert the temperature to
+        temp_units : {'celcius' / UNIT_C, 'fahrenheit' / UNIT_F} *optional
+            A name or flag identifying the unit to convert the temperature to
             If not set the stored units will be used
-        pressure_units : {default: 'pascals', 'bar'} *optional
-            A string identifying the unit to convert the pressure to
+        pressure_units : {'pascals' / UNIT_PA, 'bar' / UNIT_BAR} *optional
+            A name or flag identifying the unit to convert the pressure to
             If not set the stored units will be used
 
         Returns
@@ -213,91 +406,83 @@ class MS5803():
         tuple of ints
             Returns a tuple containing the raw or converted temp and pressure values
         '''
-        if not temp_osr:
-            temp_osr = self.temp_osr
-        else:
-            self.temp_osr = temp_osr
+        if temp_osr or pressure_osr or temp_units is not None or pressure_units is not None:
+            self._configure(temp_osr, pressure_osr, temp_units, pressure_units)
 
-        if not pressure_osr:
-            pressure_osr = self.pressure_osr
-        else:
-            self.pressure_osr = pressure_osr
+        # Retrieve ADC result
+        start = self.start_conversion
+        read = self.read_result
+        sleep_ms(start(self.TEMPERATURE))
+        temp_raw = read()
+        sleep_ms(start(self.PRESSURE))
+        pressure_raw = read()
 
-        if not temp_units:
-            temp_units = self.temp_units
-        else:
-            self.temp_units = temp_units
+        return self._calculate(temp_raw, pressure_raw)
 
-        if not pressure_units:
-            pressure_units = self.pressure_units
-        else:
-            self.pressure_units = pressure_units
+    async def get_measurements_async(self, temp_osr=None, pressure_osr=None, temp_units=None, pressure_units=None):
+        '''
+        Collect measurements, yielding to other uasyncio tasks during conversions
 
-        # Retrieve ADC result
-        temp_raw = self._get_ADC_conversion(self.TEMPERATURE, temp_osr) # TODO
-        pressure_raw = self._get_ADC_conversion(self.PRESSURE, pressure_osr) # TODO
-
-        # Convert raw temp to actual
-        dT = temp_raw - (self.C[5] << 8)
-        temp = ((dT * self.C[6]) >> 23) + 2000
-
-        # Calculate the second order temp
-        if temp < 2000:
-            T2 = 3 * ((dT * dT) >> 33)
-            OFF2 = 3 * ((temp - 2000) * (temp - 2000)) >> 1
-            SENS2 = 5 * ((temp - 2000) * (temp - 2000)) >> 3
-
-            if temp < -1500:
-                OFF2 = OFF2 + 7 * ((temp + 1500) * (temp + 1500))
-                SENS2 = SENS2 + (((temp + 1500) * (temp + 1500)) << 2)
-        else:
-            T2 = 7 * (dT * dT) >> 37
-            OFF2 = ((temp - 2000) * (temp - 2000)) >> 4
-            SENS2 = 0
+        Takes the same parameters and returns the same values as get_measurements()
+        Concurrent calls on the same sensor are serialised, as it has a single ADC
+        '''
+        import uasyncio
 
-        # Bring it all together to apply offsets 
-        OFF = (self.C[2] << 16) + (((self.C[4] * dT)) >> 7)
-        SENS = (self.C[1] << 15) + (((self.C[3] * dT)) >> 8)
+        if self._lock is None:
+            self._lock = uasyncio.Lock()
 
-        temp = temp - T2
-        OFF = OFF - OFF2
-        SENS = SENS - SENS2
+        async with self._lock:
+            if temp_osr or pressure_osr or temp_units is not None or pressure_units is not None:
+                self._configure(temp_osr, pressure_osr, temp_units, pressure_units)
 
-        # Calculate the pressure
-        pressure = (((SENS * pressure_raw) >> 21 ) - OFF) >> 15
+            await uasyncio.sleep_ms(self.start_conversion(self.TEMPERATURE))
+            temp_raw = self.read_result()
+            await uasyncio.sleep_ms(self.start_conversion(self.PRESSURE))
+            pressure_raw = self.read_result()
 
-        if temp_units:
-            temp = convert_temperature(temp, temp_units)
-        if pressure_units:
-            pressure = convert_pressure(pressure, pressure_units)
+            return self._calculate(temp_raw, pressure_raw)
 
-        return (temp, pressure)
+    @micropython.native
+    def start_conversion(self, measurement):
+        '''
+        Start an ADC conversion at the stored OSR without waiting for it
 
+        The sensor has a single ADC, so each conversion must be read with
+        read_result() before the next one is started
 
-    def _get_ADC_conversion(self, measurement, precision=None):
-        '''
-        Collect measurements
-        
         Parameters
         ----------
-        measurement: int 
-            The address of the desired measurement on the chip
-        precision: int 
-            The address modifier of the desired precision on the chip
+        measurement: int
+            MS5803.TEMPERATURE or MS5803.PRESSURE
 
         Returns
         ----------
         int
-            Returns a 3 byte int containing the reading from the ADC
+            The time in ms to wait before calling read_result()
         '''
+        if measurement == self.TEMPERATURE:
+            precision = self._temp_osr_idx
+        else:
+            precision = self._pressure_osr_idx
 
-        self.i2c.writeto_mem(self.address, CMD_ADC_CONV + measurement + precision.address, b'');
+        self.i2c.writeto_mem(self.address, self.CMD_ADC_CONV + measurement + OSR_ADDR[precision], b'')
 
-        # Wait for conversion to complete
-        sleep_ms(precision.sampling_time)
+        return OSR_MS[precision]
 
-        buf = self.i2c.readfrom_mem(self.address, self.CMD_ADC_READ, 3)
-        
-        result = (buf[0] << 16) + (buf[1] << 8) + buf[2]
+    @micropython.native
+    def read_result(self):
+        '''
+        Read the result of the last ADC conversion
+
+        Must be called once after each start_conversion(), and before the
+        next one, once the returned conversion time has passed
+
+        Returns
+        ----------
+        int
+            Returns a 3 byte int containing the reading from the ADC
+        '''
+        buf = self._adc_buf
+        self.i2c.readfrom_mem_into(self.address, self.CMD_ADC_READ, buf)
 
-        return result
+        return int.from_bytes(buf, 'big')